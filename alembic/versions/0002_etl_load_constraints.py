@@ -0,0 +1,48 @@
+"""relax constraints for ETL loads
+
+Revision ID: 0002_etl_load_constraints
+Revises: 0001_initial_schema
+Create Date: 2026-10-18 00:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0002_etl_load_constraints'
+down_revision = '0001_initial_schema'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Streaming logs carry no profile pictures or covers, and names are not unique across artists
+    op.alter_column('users', 'profile_picture_uri', existing_type=sa.String(), nullable=True)
+
+    op.drop_constraint('albums_album_name_key', 'albums', type_='unique')
+    op.alter_column('albums', 'artist_id', existing_type=sa.String(), nullable=True)
+
+    op.drop_constraint('tracks_track_name_key', 'tracks', type_='unique')
+    op.alter_column('tracks', 'album_id', existing_type=sa.String(), nullable=True)
+    op.alter_column('tracks', 'main_artist_id', existing_type=sa.String(), nullable=True)
+    op.alter_column('tracks', 'track_cover_uri', existing_type=sa.String(), nullable=True)
+
+    # History rows are keyed by the ETL's stable history_id so repeated loads are idempotent
+    op.drop_constraint('history_played_at_key', 'history', type_='unique')
+    op.add_column('history', sa.Column('history_key', sa.String(), nullable=True))
+    op.create_unique_constraint('history_history_key_key', 'history', ['history_key'])
+
+
+def downgrade():
+    op.drop_constraint('history_history_key_key', 'history', type_='unique')
+    op.drop_column('history', 'history_key')
+    op.create_unique_constraint('history_played_at_key', 'history', ['played_at'])
+
+    op.alter_column('tracks', 'track_cover_uri', existing_type=sa.String(), nullable=False)
+    op.alter_column('tracks', 'main_artist_id', existing_type=sa.String(), nullable=False)
+    op.alter_column('tracks', 'album_id', existing_type=sa.String(), nullable=False)
+    op.create_unique_constraint('tracks_track_name_key', 'tracks', ['track_name'])
+
+    op.alter_column('albums', 'artist_id', existing_type=sa.String(), nullable=False)
+    op.create_unique_constraint('albums_album_name_key', 'albums', ['album_name'])
+
+    op.alter_column('users', 'profile_picture_uri', existing_type=sa.String(), nullable=False)
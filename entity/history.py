@@ -9,15 +9,16 @@ class History(Base):
 
     Description:
     This class defines the structure of the 'history' table in the database.
-    It includes attributes such as id, user_id, track_id, played_at, ms_played, platform, country, ip_address,
+    It includes attributes such as id, history_key, user_id, track_id, played_at, ms_played, platform, country, ip_address,
     reason_start, reason_end, skipped, shuffle, offline, and incognito.
     """
     __tablename__ = 'history'
 
     id = Column(Integer, primary_key=True)
+    history_key = Column(String, unique=True, nullable=True)  # stable history_id from the ETL, used for idempotent loads
     user_id = Column(String, ForeignKey('users.id'), nullable=False)
     track_id = Column(String, ForeignKey('tracks.id'), nullable=False)
-    played_at = Column(String, unique=True, nullable=False)  # ISO 8601 format timestamp
+    played_at = Column(String, nullable=False)  # ISO 8601 format timestamp
     ms_played = Column(Integer, nullable=True)  # duration played in milliseconds
     platform = Column(String, nullable=True)  # platform used to play the track
     country = Column(String, nullable=True)  # country code where the track was played
@@ -14,12 +14,12 @@ class Track(Base):
     __tablename__ = 'tracks'
 
     id = Column(String, primary_key=True)
-    track_name = Column(String, unique=True, nullable=False)
-    album_id = Column(String, ForeignKey('albums.id'), nullable=False)
+    track_name = Column(String, nullable=False)
+    album_id = Column(String, ForeignKey('albums.id'), nullable=True)
     duration_ms = Column(Integer, nullable=True)  # duration of the track in milliseconds
-    main_artist_id = Column(String, ForeignKey('artists.id'), nullable=False)
+    main_artist_id = Column(String, ForeignKey('artists.id'), nullable=True)
     popularity = Column(Integer, nullable=True)
-    track_cover_uri = Column(String, unique=True, nullable=False)
+    track_cover_uri = Column(String, unique=True, nullable=True)
 
     # Relationships
     album = relationship('Album', back_populates='tracks')
@@ -15,7 +15,7 @@ class User(Base):
 
     id = Column(String, primary_key=True)
     display_name = Column(String, unique=True, nullable=False)
-    profile_picture_uri = Column(String, unique=True, nullable=False)
+    profile_picture_uri = Column(String, unique=True, nullable=True)
 
     def __repr__(self):
         return f"<User(id={self.id}, display_name='{self.display_name}', profile_picture_uri='{self.profile_picture_uri}')>"
@@ -3,16 +3,25 @@
 # Usage:
 #   python etl.py data
 #   python etl.py data/*.json
+#   python etl.py --resume data
+#   python etl.py --watch spool/
 #
 # Requirements:
 #   pip install pandas python-dateutil
+#   pip install pyarrow   # optional, enables stage checkpoints / --resume
 #
 # What it does:
-# - Reads one or more JSON files containing arrays of streaming records
+# - Reads one or more JSON files containing arrays of streaming records; each file's export format
+#   (extended streaming history, legacy account data, legacy podcast history) is detected once from a sample
 # - Cleans and deduplicates records
 # - Builds normalized dimension tables (User, Artist, Album, Track) and a fact table (History)
 # - Extracts “Feat” relationships (artist uri <> track uri) when multiple artists are present or inferred
+# - Checkpoints every stage to out/_checkpoints (Parquet, needs pyarrow); `--resume` reuses still-valid ones
 # - Writes CSVs for subsequent DB load (N-tier: DB + API + UI)
+# - Derives listening sessions (plays split by an inactivity gap) → Sessions table + history.session_id
+# - Watch mode (--watch DIR) micro-batches new files from a spool directory straight into the database
+# - Builds sparse artist×artist matrices (feat collaborations, same user/day co-plays) for related-artist lookups
+# - Partitions the History fact by month (history/year=YYYY/month=MM/part-N.csv) with a _manifest.json
 #
 # Notes:
 # - If your source doesn’t carry popularity/genres/photos, the ETL leaves NULL; later you can augment via Spotify API
@@ -24,12 +33,24 @@
 import os
 import sys
 import json
+import time
+import shutil
+import signal
+import argparse
 import glob
 import hashlib
-from datetime import datetime
-from dateutil import parser as dtparser
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import numpy as np
 import pandas as pd
 
+try:
+    import pyarrow  # noqa: F401  (Parquet engine for stage checkpoints)
+    HAVE_PARQUET = True
+except ImportError:
+    HAVE_PARQUET = False
+
 # ------------------ Config ------------------
 CONFIG = {
     # Basic user info (you can put multiple users if needed; this example assumes a single owner of the logs)
@@ -49,51 +70,185 @@ CONFIG = {
     },
     # Feat extraction heuristics:
     # If multiple artists are in "master_metadata_album_artist_name" (comma, &, feat, x), we split them.
+    # Read once per name and cached for the process lifetime: changing these at runtime needs
+    # split_artists.cache_clear().
     "artist_split_patterns": [",", "&", " x ", " X ", " feat. ", " ft. ", " (feat. ", ")"],
+    # Listening sessions: a user's next play starts a new session once the idle time since the previous
+    # play ended exceeds this many minutes (overridable with --session-gap)
+    "sessions": {
+        "gap_minutes": 30,
+    },
+    # Watch mode: a batch is flushed once it holds batch_files files or its oldest file has waited
+    # batch_seconds; handled files are moved into processed/ or failed/ under the spool directory
+    "watch": {
+        "batch_files": 20,
+        "batch_seconds": 5.0,
+        "poll_seconds": 1.0,
+        "processed_dir": "processed",
+        "failed_dir": "failed",
+    },
+    # Artist graphs written to out/<dir>/ as CSR .npz files. User-days with more distinct artists than
+    # max_artists_per_day are left out of the co-play matrix (pair count grows quadratically); co-play pairs
+    # are generated coplay_chunk_pairs at a time, so peak memory tracks the matrix size, not the pair count
+    "analytics": {
+        "enabled": True,
+        "dir": "analytics",
+        "max_artists_per_day": 500,
+        "coplay_chunk_pairs": 5_000_000,
+    },
+    # Output layout:
+    # Tables listed in "partition_by" are written as <table>/year=YYYY/month=MM/part-N.csv (keyed on the given
+    # timestamp column) plus a <table>/_manifest.json; every other table stays a single flat CSV.
+    "output": {
+        "partitioned": True,
+        "partition_by": {"history": "timestamp_utc"},
+        "rows_per_part": 500_000,
+        "max_workers": 4,
+    },
+    # Stage checkpoints (parsed, deduped, normalized, each dimension, fact) used by --resume
+    "checkpoints": {
+        "enabled": True,
+        "dir": os.path.join("out", "_checkpoints"),
+    },
 }
 
 OUT_DIR = "out"
 os.makedirs(OUT_DIR, exist_ok=True)
 
-# ------------------ Utils ------------------
-def read_json_arrays(paths):
-    records = []
-    for p in paths:
-        try:
-            text = open(p, "r", encoding="utf-8").read().strip()
-            # Extract the first JSON array if text has additional wrappers
-            start = text.find("[")
-            end = text.rfind("]")
-            if start != -1 and end != -1 and end > start:
-                text = text[start:end+1]
-            arr = json.loads(text)
-            if isinstance(arr, list):
-                records.extend(arr)
-        except Exception as e:
-            print(f"[WARN] Failed to parse {p}: {e}")
-    return records
+# ------------------ Input schemas ------------------
+# Export variants: canonical column -> candidate source keys (first one present in the file wins).
+# "signature" keys must all appear in a file's sampled records for the variant to match; checked in order.
+INPUT_SCHEMAS = {
+    "legacy_podcast": {  # StreamingHistory_podcast_*.json (account data)
+        "signature": ["endTime", "podcastName", "episodeName"],
+        "fields": {
+            "ts": ["endTime"],
+            "ms_played": ["msPlayed"],
+            "show_name": ["podcastName"],
+            "episode_name": ["episodeName"],
+        },
+    },
+    "legacy": {  # StreamingHistory*.json / StreamingHistory_music_*.json (account data)
+        "signature": ["endTime", "msPlayed"],
+        "fields": {
+            "ts": ["endTime"],
+            "ms_played": ["msPlayed"],
+            "artist_name": ["artistName"],
+            "track_name": ["trackName"],
+        },
+    },
+    "extended": {  # endsong_*.json / Streaming_History_Audio_*.json (extended streaming history)
+        "signature": ["ms_played"],
+        "fields": {
+            "ts": ["ts", "timestamp"],
+            "platform": ["platform"],
+            "ms_played": ["ms_played"],
+            "artist_name": ["master_metadata_album_artist_name"],
+            "track_name": ["master_metadata_track_name"],
+            "album_name": ["master_metadata_album_album_name"],
+            "conn_country": ["conn_country"],
+            "ip_addr": ["ip_addr", "ip_addr_decrypted"],
+            "track_uri": ["spotify_track_uri"],
+            "show_name": ["episode_show_name"],
+            "episode_name": ["episode_name"],
+            "episode_uri": ["spotify_episode_uri"],
+            "reason_start": ["reason_start"],
+            "reason_end": ["reason_end"],
+            "skipped": ["skipped"],
+            "offline": ["offline"],
+            "shuffle": ["shuffle"],
+            "incognito": ["incognito_mode"],
+        },
+    },
+}
+CANONICAL_FIELDS = list(dict.fromkeys(f for sch in INPUT_SCHEMAS.values() for f in sch["fields"]))
+SCHEMA_SAMPLE_SIZE = 50
 
-def parse_ts(ts):
-    if not ts:
-        return None
+def read_json_array(path):
     try:
-        dt = dtparser.isoparse(ts)
-        # Force UTC if tz-naive
-        if not dt.tzinfo:
-            dt = dt.replace(tzinfo=None)
-        return dt
-    except Exception:
-        return None
+        text = open(path, "r", encoding="utf-8").read().strip()
+        # Extract the first JSON array if text has additional wrappers
+        start = text.find("[")
+        end = text.rfind("]")
+        if start != -1 and end != -1 and end > start:
+            text = text[start:end+1]
+        arr = json.loads(text)
+        if isinstance(arr, list):
+            return [r for r in arr if isinstance(r, dict)]
+        print(f"[WARN] No JSON array in {path}")
+    except Exception as e:
+        print(f"[WARN] Failed to parse {path}: {e}")
+    return None
+
+def detect_schema(records):
+    # Sample from the head and tail of the file; exports are homogeneous, so a few records are enough
+    sample = records[:SCHEMA_SAMPLE_SIZE] + records[-SCHEMA_SAMPLE_SIZE:]
+    keys = set().union(*(r.keys() for r in sample)) if sample else set()
+    for name, schema in INPUT_SCHEMAS.items():
+        if all(k in keys for k in schema["signature"]):
+            # Compile the accessor: resolve each canonical column to the one source key this file uses
+            mapping = {}
+            for field, candidates in schema["fields"].items():
+                src = next((c for c in candidates if c in keys), None)
+                if src:
+                    mapping[src] = field
+            return name, mapping
+    return None, {}
+
+def records_to_frame(records, mapping):
+    # Column-oriented: pull only the mapped keys out of every record, then rename to canonical names
+    df = pd.DataFrame.from_records(records, columns=list(mapping)).rename(columns=mapping)
+    for field in CANONICAL_FIELDS:
+        if field not in df.columns:
+            df[field] = None
+    return df[CANONICAL_FIELDS]
+
+def read_inputs(paths, rejected=None):
+    # Files that can't be parsed or whose format isn't recognized are skipped and appended to `rejected`
+    frames = []
+    for p in paths:
+        records = read_json_array(p)
+        if records is None:
+            if rejected is not None:
+                rejected.append(p)
+            continue
+        if not records:
+            continue
+        schema, mapping = detect_schema(records)
+        if schema is None:
+            print(f"[WARN] Unrecognized record format in {p}; skipped")
+            if rejected is not None:
+                rejected.append(p)
+            continue
+        df = records_to_frame(records, mapping)
+        df["source_schema"] = schema
+        frames.append(df)
+    if not frames:
+        return pd.DataFrame(columns=CANONICAL_FIELDS + ["source_schema"])
+    return pd.concat(frames, ignore_index=True)
 
+# ------------------ Utils ------------------
 def stable_id(*parts, prefix="id_"):
     h = hashlib.sha1(("|".join(parts)).encode("utf-8")).hexdigest()[:16]
     return f"{prefix}{h}"
 
-def clean_str(s):
-    if s is None:
-        return None
-    s = str(s).strip()
-    return s if s else None
+# Cached stable_id for dimension keys (artist/album/track), which recur on every play and every batch in
+# watch mode. Per-play history/session IDs are unique and go through stable_id so they don't evict these.
+dim_id = lru_cache(maxsize=1 << 18)(stable_id)
+
+def to_utc(series):
+    # Vectorized timestamp parsing; tz-naive values (legacy endTime) are taken as UTC
+    return pd.to_datetime(series, utc=True, errors="coerce", format="ISO8601")
+
+def clean_col(col):
+    # Stringify, strip, and turn blanks into None
+    col = col.astype(object)
+    col = col.where(col.isna(), col.astype(str).str.strip())
+    return col.where(col.notna() & (col != ""), None)
+
+def flag_col(col):
+    # Vectorized bool(value): missing → False
+    return col.astype(object).where(col.notna(), False).astype(bool)
 
 def minutes(ms):
     try:
@@ -101,9 +256,11 @@ def minutes(ms):
     except Exception:
         return 0.0
 
+# Cached per name; see the note on CONFIG["artist_split_patterns"]
+@lru_cache(maxsize=1 << 16)
 def split_artists(name):
     if not name:
-        return []
+        return ()
     # normalize spaces around separators
     n = " " + name + " "
     for pat in CONFIG["artist_split_patterns"]:
@@ -116,78 +273,86 @@ def split_artists(name):
         if p.lower() not in seen:
             seen.add(p.lower())
             res.append(p)
-    return res
+    return tuple(res)
 
 # ------------------ ETL Core ------------------
-def build_tables(raw_records, user_cfg):
-    # Deduplicate by (ts, track URI) if possible; fall back to (ts, track name)
-    seen = set()
-    rows = []
-    for r in raw_records:
-        ts = r.get("ts") or r.get("timestamp") or r.get("endTime")
-        uri = r.get("spotify_track_uri")
-        tname = r.get("master_metadata_track_name")
-        key = f"{ts}|{uri or tname or ''}"
-        if key in seen:
-            continue
-        seen.add(key)
-        rows.append(r)
+def dedupe_records(raw):
+    # Deduplicate by (ts, track URI) if possible; fall back to (ts, track name); episodes likewise by URI/name
+    ident = raw["track_uri"]
+    for fallback in ("episode_uri", "track_name", "episode_name"):
+        ident = ident.where(ident.notna() & (ident != ""), raw[fallback])
+    keys = pd.DataFrame({"ts": raw["ts"], "ident": ident.fillna("")})
+    return raw[~keys.duplicated()].reset_index(drop=True)
 
+def normalize_records(raw):
     # Normalize base
-    norm = []
-    for r in rows:
-        ts = r.get("ts") or r.get("timestamp") or r.get("endTime")
-        dt = parse_ts(ts)
-        platform = clean_str(r.get("platform"))
-        ms_played = r.get("ms_played") or 0
-        artist_name = clean_str(r.get("master_metadata_album_artist_name"))
-        track_name = clean_str(r.get("master_metadata_track_name"))
-        album_name = clean_str(r.get("master_metadata_album_album_name"))
-        conn_country = clean_str(r.get("conn_country"))
-        ip_addr = clean_str(r.get("ip_addr"))
-        track_uri = clean_str(r.get("spotify_track_uri"))
-
-        reason_start = clean_str(r.get("reason_start"))
-        reason_end = clean_str(r.get("reason_end"))
-        skipped = bool(r.get("skipped"))
-        offline = bool(r.get("offline"))
-        shuffle = bool(r.get("shuffle"))
-        incognito = bool(r.get("incognito_mode"))
-
-        norm.append({
-            "ts": ts,
-            "timestamp_dt": dt,
-            "platform": platform,
-            "ms_played": ms_played,
-            "artist_name": artist_name,
-            "track_name": track_name,
-            "album_name": album_name,
-            "conn_country": conn_country,
-            "ip_addr": ip_addr,
-            "track_uri": track_uri,
-            "reason_start": reason_start,
-            "reason_end": reason_end,
-            "skipped": skipped,
-            "offline": offline,
-            "shuffle": shuffle,
-            "incognito": incognito,
-        })
+    track_name = clean_col(raw["track_name"])
+    episode_name = clean_col(raw["episode_name"])
+    is_episode = (raw["source_schema"] == "legacy_podcast") | (track_name.isna() & episode_name.notna())
+    # Episodes map onto the music model as show → artist, episode → track (no album)
+    return pd.DataFrame({
+        "ts": raw["ts"].astype(object).where(raw["ts"].notna(), None),
+        "timestamp_dt": to_utc(raw["ts"]),
+        "platform": clean_col(raw["platform"]),
+        "ms_played": pd.to_numeric(raw["ms_played"], errors="coerce").fillna(0),
+        "artist_name": clean_col(raw["artist_name"]).where(~is_episode, clean_col(raw["show_name"])),
+        "track_name": track_name.where(~is_episode, episode_name),
+        "album_name": clean_col(raw["album_name"]).where(~is_episode, None),
+        "conn_country": clean_col(raw["conn_country"]),
+        "ip_addr": clean_col(raw["ip_addr"]),
+        "track_uri": clean_col(raw["track_uri"]).where(~is_episode, clean_col(raw["episode_uri"])),
+        "content_type": np.where(is_episode, "episode", "track"),
+        "reason_start": clean_col(raw["reason_start"]),
+        "reason_end": clean_col(raw["reason_end"]),
+        "skipped": flag_col(raw["skipped"]),
+        "offline": flag_col(raw["offline"]),
+        "shuffle": flag_col(raw["shuffle"]),
+        "incognito": flag_col(raw["incognito"]),
+    })
+
+def row_artists(row):
+    # Show names are kept whole: "&" or "," in a podcast title doesn't mean a collaboration
+    if row["content_type"] == "episode":
+        return [row["artist_name"]] if row["artist_name"] else []
+    return split_artists(row["artist_name"])
+
+# Column sets of the output tables, so an empty table (e.g. no albums in a legacy or podcast-only batch)
+# still has its schema
+ARTIST_COLUMNS = ["artist_id", "artist_name", "popularity", "photo_url", "genres"]
+ALBUM_COLUMNS = ["album_id", "album_name", "artist_name", "release_date", "total_tracks", "photo_url"]
+TRACK_COLUMNS = ["track_id", "track_uri", "track_name", "album_id", "main_artist_name", "duration_ms",
+                 "popularity", "photo_url"]
+FEAT_COLUMNS = ["artist_id", "track_id"]
+HISTORY_COLUMNS = ["history_id", "user_id", "track_id", "artist_id", "timestamp_utc", "ms_played", "platform",
+                   "country", "ip_addr", "reason_start", "reason_end", "skipped", "offline", "shuffle",
+                   "incognito", "content_type"]
 
-    df = pd.DataFrame(norm)
+def track_key(row):
+    # Track ID prefers URI; otherwise derive from name + album. Legacy/podcast rows have neither URI nor
+    # album, so the first artist (or show) is added to keep "Intro" by two artists apart.
+    if row["track_uri"]:
+        return dim_id(row["track_uri"], prefix="track_")
+    name = (row["track_name"] or "").lower()
+    if row["album_name"]:
+        return dim_id(name, row["album_name"].lower(), prefix="track_")
+    first_artist = row_artists(row)[0] if row_artists(row) else ""
+    return dim_id(name, "", first_artist.lower(), prefix="track_")
 
+def build_users(user_cfg):
     # Dimension: Users (single record from config)
-    users = pd.DataFrame([{
+    return pd.DataFrame([{
         "user_id": user_cfg["user_id"],
         "display_name": user_cfg["display_name"],
         "profile_picture_url": user_cfg["profile_picture_url"]
     }])
 
+def build_artists(df):
     # Dimension: Artists
     # Extract unique artists (including feat splits)
     artist_rows = []
     for _, row in df.iterrows():
-        for name in split_artists(row["artist_name"]):
-            aid = stable_id(name.lower(), prefix="artist_")
+        for name in row_artists(row):
+            aid = dim_id(name.lower(), prefix="artist_")
             artist_rows.append({
                 "artist_id": aid,
                 "artist_name": name,
@@ -195,8 +360,9 @@ def build_tables(raw_records, user_cfg):
                 "photo_url": CONFIG["default_values"]["artist_photo"],
                 "genres": CONFIG["default_values"]["artist_genres"],  # later enrichment
             })
-    artists = pd.DataFrame(artist_rows).drop_duplicates(subset=["artist_id"])
+    return pd.DataFrame(artist_rows, columns=ARTIST_COLUMNS).drop_duplicates(subset=["artist_id"])
 
+def build_albums(df):
     # Dimension: Albums
     album_rows = []
     for _, row in df.iterrows():
@@ -204,8 +370,8 @@ def build_tables(raw_records, user_cfg):
         if not alb:
             continue
         # We cannot reliably get album URI from logs; derive ID from name + first artist
-        first_artist = split_artists(row["artist_name"])[0] if split_artists(row["artist_name"]) else None
-        album_id = stable_id((alb or "").lower(), (first_artist or "").lower(), prefix="album_")
+        first_artist = row_artists(row)[0] if row_artists(row) else None
+        album_id = dim_id((alb or "").lower(), (first_artist or "").lower(), prefix="album_")
         album_rows.append({
             "album_id": album_id,
             "album_name": alb,
@@ -214,8 +380,9 @@ def build_tables(raw_records, user_cfg):
             "total_tracks": None,  # later enrichment via API
             "photo_url": CONFIG["default_values"]["album_photo"],
         })
-    albums = pd.DataFrame(album_rows).drop_duplicates(subset=["album_id"])
+    return pd.DataFrame(album_rows, columns=ALBUM_COLUMNS).drop_duplicates(subset=["album_id"])
 
+def build_tracks(df):
     # Dimension: Tracks
     track_rows = []
     for _, row in df.iterrows():
@@ -223,12 +390,10 @@ def build_tables(raw_records, user_cfg):
         if not tname:
             continue
         t_uri = row["track_uri"] or None
-        # Track ID prefers URI; otherwise derive from name + album
-        tid = (stable_id(t_uri, prefix="track_") if t_uri
-               else stable_id((tname or "").lower(), (row["album_name"] or "").lower(), prefix="track_"))
+        tid = track_key(row)
         # Link to album_id
-        first_artist = split_artists(row["artist_name"])[0] if split_artists(row["artist_name"]) else None
-        album_id = stable_id((row["album_name"] or "").lower(), (first_artist or "").lower(), prefix="album_")
+        first_artist = row_artists(row)[0] if row_artists(row) else None
+        album_id = dim_id((row["album_name"] or "").lower(), (first_artist or "").lower(), prefix="album_")
         track_rows.append({
             "track_id": tid,
             "track_uri": t_uri,
@@ -239,39 +404,40 @@ def build_tables(raw_records, user_cfg):
             "popularity": CONFIG["default_values"]["track_popularity"],
             "photo_url": CONFIG["default_values"]["track_photo"],
         })
-    tracks = pd.DataFrame(track_rows).drop_duplicates(subset=["track_id"])
+    return pd.DataFrame(track_rows, columns=TRACK_COLUMNS).drop_duplicates(subset=["track_id"])
 
-    # Bridge: Track <-> Artist (including Feat)
-    feat_rows = []
+def artist_id_map(artists):
     # Map artist_name → artist_id
-    artist_map = {row["artist_name"].lower(): row["artist_id"] for _, row in artists.iterrows()}
+    return {row["artist_name"].lower(): row["artist_id"] for _, row in artists.iterrows()}
 
+def build_feat(df, artists):
+    # Bridge: Track <-> Artist (including Feat)
+    feat_rows = []
+    artist_map = artist_id_map(artists)
     for _, row in df.iterrows():
-        t_uri = row["track_uri"] or None
-        track_id = (stable_id(t_uri, prefix="track_") if t_uri
-                    else stable_id((row["track_name"] or "").lower(), (row["album_name"] or "").lower(), prefix="track_"))
-        for name in split_artists(row["artist_name"]):
+        track_id = track_key(row)
+        for name in row_artists(row):
             aid = artist_map.get(name.lower())
             if aid:
                 feat_rows.append({
                     "artist_id": aid,
                     "track_id": track_id
                 })
-    feat = pd.DataFrame(feat_rows).drop_duplicates(subset=["artist_id", "track_id"])
+    return pd.DataFrame(feat_rows, columns=FEAT_COLUMNS).drop_duplicates(subset=["artist_id", "track_id"])
 
+def build_history(df, artists, user_cfg):
     # Fact: History (per play)
+    artist_map = artist_id_map(artists)
     history_rows = []
     for _, row in df.iterrows():
         # foreign keys
-        t_uri = row["track_uri"] or None
-        track_id = (stable_id(t_uri, prefix="track_") if t_uri
-                    else stable_id((row["track_name"] or "").lower(), (row["album_name"] or "").lower(), prefix="track_"))
-        first_artist = split_artists(row["artist_name"])[0] if split_artists(row["artist_name"]) else None
+        track_id = track_key(row)
+        first_artist = row_artists(row)[0] if row_artists(row) else None
         artist_id = artist_map.get(first_artist.lower()) if first_artist else None
 
         # Parse timestamp
         ts_dt = row["timestamp_dt"]
-        ts_iso = ts_dt.isoformat() if ts_dt else None
+        ts_iso = ts_dt.isoformat() if pd.notna(ts_dt) else None
 
         history_id = stable_id(user_cfg["user_id"], track_id, row["ts"] or "", prefix="hist_")
 
@@ -291,38 +457,691 @@ def build_tables(raw_records, user_cfg):
             "offline": bool(row["offline"]),
             "shuffle": bool(row["shuffle"]),
             "incognito": bool(row["incognito"]),
+            "content_type": row["content_type"],
         })
-    history = pd.DataFrame(history_rows)
+    return pd.DataFrame(history_rows, columns=HISTORY_COLUMNS)
 
+def finalize_tables(tables):
     # Deduplicate any lingering collisions
-    for name, df_ in [("users", users), ("artists", artists), ("albums", albums), ("tracks", tracks), ("feat", feat), ("history", history)]:
+    for df_ in tables.values():
         df_.drop_duplicates(inplace=True)
+    return tables
+
+def build_tables(raw, user_cfg, tables=None):
+    # In-memory run of the stage graph (no checkpoints) on an already parsed input frame
+    return run_stages({"user_cfg": user_cfg}, tables=tables, results={"parsed": raw})
+
+# ------------------ Sessions ------------------
+EPOCH = pd.Timestamp(0, tz="UTC")
+
+def play_bounds_ms(history):
+    # "ts" marks the end of playback, so a play spans [ts - ms_played, ts]; returns epoch-ms arrays
+    end = to_utc(history["timestamp_utc"])
+    end_ms = ((end - EPOCH) // pd.Timedelta(milliseconds=1)).to_numpy(dtype=np.int64)
+    ms = np.clip(history["ms_played"].fillna(0).to_numpy(dtype=np.int64), 0, None)
+    return end_ms - ms, end_ms
+
+def ms_to_iso(ms):
+    return [t.isoformat() for t in pd.to_datetime(ms, unit="ms", utc=True)]
+
+def assign_sessions(history, gap_minutes):
+    history = history.drop_duplicates().reset_index(drop=True)
+    history["session_id"] = None
+    valid = to_utc(history["timestamp_utc"]).notna().to_numpy()
+    if not valid.any():
+        return history
+
+    v = history[valid].copy()
+    v["_end"] = to_utc(v["timestamp_utc"])
+    v = v.sort_values(["user_id", "_end"], kind="mergesort")
+    start_ms, end_ms = play_bounds_ms(v)
+    users = v["user_id"].to_numpy()
+
+    # Session boundaries: first row, user change, or idle gap above threshold; cumsum numbers the sessions
+    new = np.ones(len(v), dtype=bool)
+    new[1:] = (users[1:] != users[:-1]) | (start_ms[1:] - end_ms[:-1] > gap_minutes * 60_000)
+    seq = np.cumsum(new) - 1
+    first = np.flatnonzero(new)
+    first_ts = v["timestamp_utc"].to_numpy()[first]
+    ids = np.array([stable_id(u, t, prefix="sess_") for u, t in zip(users[first], first_ts)], dtype=object)
+
+    history.loc[v.index, "session_id"] = ids[seq]
+    return history
+
+def build_sessions(history):
+    # Per-session aggregates over the session_id assigned by assign_sessions
+    v = history[history["session_id"].notna()]
+    start_ms, end_ms = play_bounds_ms(v)
+    agg = pd.DataFrame({
+        "session_id": v["session_id"].to_numpy(),
+        "user_id": v["user_id"].to_numpy(),
+        "start_ms": start_ms,
+        "end_ms": end_ms,
+        "ms_played": end_ms - start_ms,
+        "skipped": v["skipped"].fillna(False).to_numpy(dtype=bool),
+    }).groupby("session_id", sort=False).agg(
+        user_id=("user_id", "first"),
+        start_ms=("start_ms", "min"),
+        end_ms=("end_ms", "max"),
+        ms_played=("ms_played", "sum"),
+        track_count=("skipped", "size"),
+        skip_count=("skipped", "sum"),
+    ).reset_index()
+    return pd.DataFrame({
+        "session_id": agg["session_id"],
+        "user_id": agg["user_id"],
+        "started_at_utc": ms_to_iso(agg["start_ms"]),
+        "ended_at_utc": ms_to_iso(agg["end_ms"]),
+        "duration_ms": agg["end_ms"] - agg["start_ms"],
+        "ms_played": agg["ms_played"],
+        "track_count": agg["track_count"],
+        "skip_count": agg["skip_count"],
+        "skip_ratio": agg["skip_count"] / agg["track_count"],
+    }).sort_values(["user_id", "started_at_utc"]).reset_index(drop=True)
+
+# ------------------ Artist graphs ------------------
+# Matrices are dicts of NumPy arrays in CSR form: row i's neighbors are indices[indptr[i]:indptr[i+1]]
+# with weights data[...]; rows/cols index into artist_ids (sorted artist_id values).
+
+def group_pairs(groups, items):
+    # All (a, b) item pairs with a before b inside each group, without materializing a join.
+    # `groups` must be sorted; each row pairs with the rows after it up to the end of its group.
+    n = len(groups)
+    if n < 2:
+        return np.empty(0, dtype=items.dtype), np.empty(0, dtype=items.dtype)
+    bounds = np.flatnonzero(np.diff(groups)) + 1
+    group_end = np.repeat(np.append(bounds, n), np.diff(np.concatenate(([0], bounds, [n]))))
+    counts = group_end - np.arange(n) - 1
+    left = np.repeat(np.arange(n), counts)
+    right = left + 1 + np.arange(len(left)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return items[left], items[right]
+
+def sum_by_key(keys, weights):
+    # (unique sorted keys, summed weights)
+    uniq, inv = np.unique(keys, return_inverse=True)
+    return uniq, np.bincount(inv, weights=weights, minlength=len(uniq)).astype(np.int64)
+
+def coo_to_csr(rows, cols, n, weights=None):
+    # Symmetric CSR from undirected COO edges; duplicate edges are summed into the weight (1 per edge by default)
+    r = np.concatenate([rows, cols]).astype(np.int64)
+    c = np.concatenate([cols, rows]).astype(np.int64)
+    w = np.ones(len(r), dtype=np.int64) if weights is None else np.concatenate([weights, weights])
+    keys, weights = sum_by_key(r * n + c, w)
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys // n, minlength=n), out=indptr[1:])
+    return {
+        "indptr": indptr,
+        "indices": (keys % n).astype(np.int32),
+        "data": weights.astype(np.int32),
+        "shape": np.array([n, n], dtype=np.int64),
+    }
+
+def artist_codes(artist_ids, values):
+    return pd.Categorical(values, categories=artist_ids).codes.astype(np.int32)
+
+def build_collab_matrix(feat, artist_ids):
+    # artist×artist: number of tracks the two artists appear on together
+    codes = artist_codes(artist_ids, feat["artist_id"])
+    tracks = pd.factorize(feat["track_id"])[0]
+    keep = codes >= 0
+    order = np.argsort(tracks[keep], kind="stable")
+    a, b = group_pairs(tracks[keep][order], codes[keep][order])
+    mask = a != b
+    return coo_to_csr(a[mask], b[mask], len(artist_ids))
+
+def build_coplay_matrix(history, artist_ids, max_artists_per_day, chunk_pairs=5_000_000):
+    # artist×artist: number of (user, UTC day) buckets in which both artists were played
+    day = to_utc(history["timestamp_utc"]).dt.floor("D")
+    codes = artist_codes(artist_ids, history["artist_id"])
+    buckets = pd.DataFrame({"user_id": history["user_id"], "day": day}).groupby(
+        ["user_id", "day"], sort=False).ngroup().to_numpy()
+    keep = (codes >= 0) & (buckets >= 0)
+    # one entry per (bucket, artist): repeat plays in a day don't add weight
+    pairs = np.unique(buckets[keep].astype(np.int64) * len(artist_ids) + codes[keep])
+    groups, items = pairs // len(artist_ids), (pairs % len(artist_ids)).astype(np.int32)
+    sizes = np.bincount(groups)
+    small = sizes[groups] <= max_artists_per_day
+    skipped = int((sizes > max_artists_per_day).sum())
+    if skipped:
+        print(f"[WARN] Co-play: skipped {skipped} user-day(s) with more than {max_artists_per_day} artists")
+    groups, items = groups[small], items[small]
+
+    # Walk the user-day buckets in runs of about chunk_pairs pairs (a bucket is never split). Each run is
+    # reduced to unique (a, b) keys with counts and merged into the running total, so only the running
+    # nonzeros plus one chunk are ever in memory.
+    n = len(artist_ids)
+    sizes = np.bincount(groups).astype(np.int64) if len(groups) else np.zeros(0, dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(sizes)))
+    pair_ends = np.cumsum(sizes * (sizes - 1) // 2)
+    total_keys, total_w = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    g = 0
+    while g < len(sizes):
+        done = pair_ends[g - 1] if g else 0
+        g_end = max(int(np.searchsorted(pair_ends, done + chunk_pairs, side="right")), g + 1)
+        a, b = group_pairs(groups[starts[g]:starts[g_end]], items[starts[g]:starts[g_end]])
+        # items are ascending within a bucket, so a < b and (a, b) is the canonical key of the edge
+        chunk_keys, chunk_w = sum_by_key(a.astype(np.int64) * n + b, np.ones(len(a), dtype=np.int64))
+        total_keys, total_w = sum_by_key(np.concatenate([total_keys, chunk_keys]),
+                                         np.concatenate([total_w, chunk_w]))
+        g = g_end
+    return coo_to_csr(total_keys // max(n, 1), total_keys % max(n, 1), n, weights=total_w)
+
+def top_k_neighbors(matrix, artist_ids, artist_id, k=10):
+    # [(artist_id, weight)] sorted by weight desc, ties by artist_id; [] for unknown artists
+    i = np.searchsorted(artist_ids, artist_id)
+    if i >= len(artist_ids) or artist_ids[i] != artist_id:
+        return []
+    lo, hi = matrix["indptr"][i], matrix["indptr"][i + 1]
+    idx, w = matrix["indices"][lo:hi], matrix["data"][lo:hi]
+    if len(w) > k:
+        # keep every entry tied with the k-th weight so the tie-break below sees the whole tie group
+        kth = np.partition(w, len(w) - k)[len(w) - k]
+        keep = w >= kth
+        idx, w = idx[keep], w[keep]
+    order = np.lexsort((idx, -w))[:k]
+    return [(str(artist_ids[j]), int(x)) for j, x in zip(idx[order], w[order])]
 
+def save_matrix(path, matrix, artist_ids):
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez_compressed(f, artist_ids=np.asarray(artist_ids, dtype=str), **matrix)
+    os.replace(tmp, path)
+    return path
+
+def load_matrix(path):
+    # Returns (matrix, artist_ids); artist_ids is sorted, as top_k_neighbors expects
+    with np.load(path) as z:
+        matrix = {k: z[k] for k in ("indptr", "indices", "data", "shape")}
+        return matrix, z["artist_ids"]
+
+def write_artist_graphs(tables, out_dir=OUT_DIR, cfg=None):
+    cfg = cfg or CONFIG["analytics"]
+    graph_dir = os.path.join(out_dir, cfg["dir"])
+    os.makedirs(graph_dir, exist_ok=True)
+    artist_ids = np.sort(tables["artists"]["artist_id"].dropna().unique().astype(str))
+    graphs = {
+        "artist_collab": build_collab_matrix(tables["feat"], artist_ids),
+        "artist_coplay": build_coplay_matrix(tables["history"], artist_ids, cfg["max_artists_per_day"],
+                                             cfg["coplay_chunk_pairs"]),
+    }
+    for name, matrix in graphs.items():
+        save_matrix(os.path.join(graph_dir, f"{name}.npz"), matrix, artist_ids)
+    print(f"[OK] Artist graphs written to {os.path.abspath(graph_dir)}")
+    return graphs
+
+# ------------------ Checkpoints ------------------
+# Hash of this module's source: any code change invalidates checkpoints written by older code
+with open(os.path.abspath(__file__), "rb") as _src:
+    CODE_FINGERPRINT = hashlib.sha1(_src.read()).hexdigest()
+
+# stage -> (upstream stages, fn(ctx, *upstream results)); resolved lazily so a valid downstream
+# checkpoint never forces its upstream stages to be loaded or recomputed
+PIPELINE_STAGES = {
+    "parsed": ([], lambda ctx: read_inputs(ctx["inputs"])),
+    "deduped": (["parsed"], lambda ctx, raw: dedupe_records(raw)),
+    "normalized": (["deduped"], lambda ctx, rows: normalize_records(rows)),
+    "users": ([], lambda ctx: build_users(ctx["user_cfg"])),
+    "artists": (["normalized"], lambda ctx, df: build_artists(df)),
+    "albums": (["normalized"], lambda ctx, df: build_albums(df)),
+    "tracks": (["normalized"], lambda ctx, df: build_tracks(df)),
+    "feat": (["normalized", "artists"], lambda ctx, df, artists: build_feat(df, artists)),
+    "history": (["normalized", "artists"], lambda ctx, df, artists: build_history(df, artists, ctx["user_cfg"])),
+    "sessionized_history": (["history"],
+                            lambda ctx, history: assign_sessions(history, CONFIG["sessions"]["gap_minutes"])),
+    "sessions": (["sessionized_history"], lambda ctx, history: build_sessions(history)),
+}
+# Config sections that only affect some stages; they are left out of the run fingerprint and folded
+# into those stages' fingerprints instead, so tuning them only invalidates what they feed
+STAGE_CONFIG = {
+    "sessionized_history": "sessions",
+    "sessions": "sessions",
+}
+# output table -> stage producing it
+TABLE_STAGES = {
+    "users": "users",
+    "artists": "artists",
+    "albums": "albums",
+    "tracks": "tracks",
+    "feat": "feat",
+    "history": "sessionized_history",
+    "sessions": "sessions",
+}
+
+def run_fingerprint(inputs, user_cfg):
+    # Inputs are identified by path + size + mtime, stage code by CODE_FINGERPRINT; output settings are
+    # excluded so that changing only the output stage keeps every checkpoint valid
+    payload = {
+        "code": CODE_FINGERPRINT,
+        "inputs": [[os.path.abspath(p), os.path.getsize(p), os.stat(p).st_mtime_ns] for p in sorted(inputs)],
+        "user": user_cfg,
+        "config": {k: v for k, v in CONFIG.items()
+                   if k not in ("output", "checkpoints", "watch", "analytics")
+                   and k not in STAGE_CONFIG.values()},
+    }
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def stage_fingerprint(run_fp, stage):
+    if stage not in STAGE_CONFIG:
+        return run_fp
+    payload = [run_fp, stage, CONFIG[STAGE_CONFIG[stage]]]
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def load_checkpoint(ckpt_dir, stage, fingerprint):
+    meta_path = os.path.join(ckpt_dir, f"{stage}.json")
+    data_path = os.path.join(ckpt_dir, f"{stage}.parquet")
+    if not (os.path.exists(meta_path) and os.path.exists(data_path)):
+        return None
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("fingerprint") != fingerprint:
+            return None
+        df = pd.read_parquet(data_path)
+    except Exception as e:
+        print(f"[WARN] Ignoring unreadable checkpoint {stage}: {e}")
+        return None
+    return df
+
+def save_checkpoint(ckpt_dir, stage, fingerprint, result):
+    data_path = os.path.join(ckpt_dir, f"{stage}.parquet")
+    try:
+        result.to_parquet(f"{data_path}.tmp", index=False)
+    except Exception as e:
+        # e.g. a column mixing ints and strings; the run goes on, this stage just won't be resumable
+        print(f"[WARN] Could not checkpoint {stage}: {e}")
+        return
+    os.replace(f"{data_path}.tmp", data_path)
+    atomic_write_json({
+        "stage": stage,
+        "fingerprint": fingerprint,
+        "rows": int(len(result)),
+        "written_at": datetime.now(timezone.utc).isoformat(),
+    }, os.path.join(ckpt_dir, f"{stage}.json"))
+
+def run_pipeline(inputs, user_cfg, resume=False, ckpt_cfg=None):
+    ckpt_cfg = ckpt_cfg or CONFIG["checkpoints"]
+    enabled = ckpt_cfg["enabled"] and HAVE_PARQUET
+    if ckpt_cfg["enabled"] and not HAVE_PARQUET:
+        print("[WARN] pyarrow not installed; stage checkpoints disabled")
+    if resume and not enabled:
+        print("[WARN] --resume ignored: checkpoints are disabled")
+    ckpt_dir = ckpt_cfg["dir"]
+    if enabled:
+        os.makedirs(ckpt_dir, exist_ok=True)
+    fingerprint = run_fingerprint(inputs, user_cfg)
+    ctx = {"inputs": inputs, "user_cfg": user_cfg}
+
+    def load(stage):
+        if not (enabled and resume):
+            return None
+        cached = load_checkpoint(ckpt_dir, stage, stage_fingerprint(fingerprint, stage))
+        if cached is not None:
+            print(f"[CKPT] {stage}: resumed from checkpoint")
+        return cached
+
+    def save(stage, result):
+        if enabled:
+            save_checkpoint(ckpt_dir, stage, stage_fingerprint(fingerprint, stage), result)
+
+    return run_stages(ctx, load=load, save=save)
+
+def run_stages(ctx, tables=None, results=None, load=None, save=None):
+    # Resolves the output tables (name -> stage, default TABLE_STAGES) through PIPELINE_STAGES; only the
+    # stages they need are run. `results` pre-seeds stages (e.g. parsed input); load(stage) / save(stage, result)
+    # are the checkpoint hooks
+    results = dict(results or {})
+
+    def resolve(stage):
+        if stage in results:
+            return results[stage]
+        cached = load(stage) if load else None
+        if cached is not None:
+            results[stage] = cached
+            return cached
+        deps, fn = PIPELINE_STAGES[stage]
+        result = fn(ctx, *[resolve(d) for d in deps])
+        if stage == "parsed" and result.empty:
+            print("[ERR] No records after parsing.")
+            sys.exit(1)
+        if save:
+            save(stage, result)
+        results[stage] = result
+        return result
+
+    return finalize_tables({name: resolve(stage) for name, stage in (tables or TABLE_STAGES).items()})
+
+# ------------------ DB load ------------------
+DB_TABLE_ORDER = ["users", "artists", "albums", "tracks", "feats", "history"]
+# DB table -> natural key used to skip rows already loaded
+DB_KEYS = {
+    "users": ("id",),
+    "artists": ("id",),
+    "albums": ("id",),
+    "tracks": ("id",),
+    "feats": ("track_id", "artist_id"),
+    "history": ("history_key",),
+}
+# Tables whose loaded keys are kept in memory across watch batches (bounded by the catalog size)
+DB_REMEMBERED = {"users", "artists", "albums", "tracks", "feats"}
+
+# Tables loaded into the DB: sessions are not part of the entity/ schema, so watch mode takes history straight
+# from the fact stage and never runs the session stages
+DB_TABLE_STAGES = {name: stage for name, stage in TABLE_STAGES.items() if name != "sessions"}
+DB_TABLE_STAGES["history"] = "history"
+
+def database_url():
+    # Same resolution as alembic/env.py, with the SQLite dev.db fallback of scripts/create_db.py
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except Exception:
+        pass
+    url = os.getenv("DATABASE_URL")
+    if url:
+        return url
+    user, password, name = os.getenv("DB_USER"), os.getenv("DB_PASSWORD"), os.getenv("DB_NAME")
+    if user and password and name:
+        host, port = os.getenv("DB_HOST", "localhost"), os.getenv("DB_PORT", "5432")
+        return f"postgresql+psycopg2://{user}:{password}@{host}:{port}/{name}"
+    return f"sqlite:///{os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dev.db')}"
+
+def frame_records(df, columns):
+    # DataFrame → list of dicts with plain Python values and None for missing
+    df = df.rename(columns=columns)[list(columns.values())]
+    return df.astype(object).where(df.notna(), None).to_dict("records")
+
+def db_rows(tables):
+    # Map ETL tables onto the entity/ schema
+    album_ids = set(tables["albums"]["album_id"])
+
+    def artist_ref(name):
+        return dim_id(name.lower(), prefix="artist_") if isinstance(name, str) and name else None
+
+    albums = tables["albums"].assign(artist_id=tables["albums"]["artist_name"].map(artist_ref))
+    tracks = tables["tracks"].assign(
+        main_artist_id=tables["tracks"]["main_artist_name"].map(artist_ref),
+        album_id=tables["tracks"]["album_id"].where(tables["tracks"]["album_id"].isin(album_ids), None),
+    )
+    # Plays with neither track nor episode metadata (removed tracks, audiobooks) reference no tracks row, and
+    # played_at is NOT NULL: such rows would break the foreign key / constraint and fail the whole batch
+    track_ids = set(tables["tracks"]["track_id"])
+    history = tables["history"]
+    loadable = history["track_id"].isin(track_ids) & history["timestamp_utc"].notna()
+    if not loadable.all():
+        print(f"[WARN] Skipped {int((~loadable).sum())} play(s) without a known track or timestamp")
+    feat = tables["feat"][tables["feat"]["track_id"].isin(track_ids)]
     return {
-        "users": users,
-        "artists": artists,
-        "albums": albums,
-        "tracks": tracks,
-        "feat": feat,
-        "history": history,
+        "users": frame_records(tables["users"], {
+            "user_id": "id", "display_name": "display_name", "profile_picture_url": "profile_picture_uri"}),
+        "artists": frame_records(tables["artists"], {
+            "artist_id": "id", "artist_name": "name", "popularity": "popularity",
+            "photo_url": "profile_picture_uri", "genres": "genre"}),
+        "albums": frame_records(albums, {
+            "album_id": "id", "album_name": "album_name", "artist_id": "artist_id", "release_date": "release_date",
+            "photo_url": "cover_image_uri", "total_tracks": "total_tracks"}),
+        "tracks": frame_records(tracks, {
+            "track_id": "id", "track_name": "track_name", "album_id": "album_id", "duration_ms": "duration_ms",
+            "main_artist_id": "main_artist_id", "popularity": "popularity", "photo_url": "track_cover_uri"}),
+        "feats": frame_records(feat, {"track_id": "track_id", "artist_id": "artist_id"}),
+        "history": frame_records(history[loadable], {
+            "history_id": "history_key", "user_id": "user_id", "track_id": "track_id", "timestamp_utc": "played_at",
+            "ms_played": "ms_played", "platform": "platform", "country": "country", "ip_addr": "ip_address",
+            "reason_start": "reason_start", "reason_end": "reason_end", "skipped": "skipped",
+            "shuffle": "shuffle", "offline": "offline", "incognito": "incognito"}),
     }
 
-def write_csvs(tables, out_dir=OUT_DIR):
-    tables["users"].to_csv(os.path.join(out_dir, "users.csv"), index=False)
-    tables["artists"].to_csv(os.path.join(out_dir, "artists.csv"), index=False)
-    tables["albums"].to_csv(os.path.join(out_dir, "albums.csv"), index=False)
-    tables["tracks"].to_csv(os.path.join(out_dir, "tracks.csv"), index=False)
-    tables["feat"].to_csv(os.path.join(out_dir, "feat.csv"), index=False)
-    tables["history"].to_csv(os.path.join(out_dir, "history.csv"), index=False)
+def load_tables(engine, tables, known):
+    # Insert new rows in one transaction; `known` holds dimension keys already in the DB (updated only after
+    # commit). Play keys are not remembered (one per play would grow without bound in a daemon): history
+    # dedup is left to the history_key unique constraint. Conflicts are ignored, so reloading a file is harmless.
+    from sqlalchemy import insert
+    from sqlalchemy.dialects import postgresql, sqlite
+    from entity.base import Base
+    import entity.artist, entity.album, entity.track, entity.user, entity.history, entity.feat  # noqa: F401
+
+    dialect_insert = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}.get(engine.dialect.name)
+    rows = db_rows(tables)
+    fresh = {}
+    with engine.begin() as conn:
+        for name in DB_TABLE_ORDER:
+            keys = DB_KEYS[name]
+            seen = known.setdefault(name, set()) if name in DB_REMEMBERED else set()
+            batch = {}
+            for r in rows[name]:
+                k = tuple(r[c] for c in keys)
+                if k not in seen and k not in batch:
+                    batch[k] = r
+            if not batch:
+                continue
+            table = Base.metadata.tables[name]
+            stmt = dialect_insert(table).on_conflict_do_nothing() if dialect_insert else insert(table)
+            conn.execute(stmt, list(batch.values()))
+            fresh[name] = batch.keys()
+    for name, keys in fresh.items():
+        if name in DB_REMEMBERED:
+            known[name].update(keys)
+    return {name: len(keys) for name, keys in fresh.items()}
+
+# ------------------ Watch mode ------------------
+def watch(spool_dir, user_cfg, watch_cfg=None, engine=None):
+    watch_cfg = watch_cfg or CONFIG["watch"]
+    if engine is None:
+        from sqlalchemy import create_engine
+        engine = create_engine(database_url())
+    processed_dir = os.path.join(spool_dir, watch_cfg["processed_dir"])
+    failed_dir = os.path.join(spool_dir, watch_cfg["failed_dir"])
+    os.makedirs(processed_dir, exist_ok=True)
+    os.makedirs(failed_dir, exist_ok=True)
+
+    stop = []
+    def request_stop(signum, frame):
+        print(f"[WATCH] signal {signum}: flushing pending files and stopping")
+        stop.append(signum)
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    known = {}       # dimension keys already loaded, per table (dedup state shared across batches)
+    last_stat = {}   # path -> (size, mtime_ns) at previous poll; a file is ready once it stops changing
+    ready = {}       # path -> time it became ready
+    totals = {"batches": 0, "files": 0, "rows": 0}
+
+    def flush(paths):
+        started = time.monotonic()
+        rejected = []
+        try:
+            raw = read_inputs(paths, rejected)
+            if raw.empty:
+                raise ValueError("no records")
+            tables = build_tables(raw, user_cfg, tables=DB_TABLE_STAGES)
+            inserted = load_tables(engine, tables, known)
+        except Exception as e:
+            print(f"[WARN] Batch of {len(paths)} file(s) failed: {e}")
+            dest = failed_dir
+        else:
+            dest = processed_dir
+            totals["batches"] += 1
+            totals["files"] += len(paths) - len(rejected)
+            totals["rows"] += inserted.get("history", 0)
+            lag = time.time() - min(ready[p] for p in paths)
+            print(f"[WATCH] {len(paths) - len(rejected)} file(s) → {inserted.get('history', 0)} plays sent "
+                  f"(duplicates skipped by the DB) in {time.monotonic() - started:.2f}s (oldest file waited {lag:.1f}s)")
+        for p in paths:
+            # unreadable / unrecognized files never reach the DB, even when the rest of the batch loads
+            shutil.move(p, os.path.join(failed_dir if p in rejected else dest, os.path.basename(p)))
+            ready.pop(p, None)
+            last_stat.pop(p, None)
+
+    print(f"[WATCH] Watching {os.path.abspath(spool_dir)}")
+    try:
+        while True:
+            for p in glob.glob(os.path.join(spool_dir, "*.json")):
+                if p in ready:
+                    continue
+                try:
+                    st = os.stat(p)
+                except FileNotFoundError:
+                    continue
+                stat = (st.st_size, st.st_mtime_ns)
+                if last_stat.get(p) == stat:
+                    ready[p] = time.time()
+                last_stat[p] = stat
+
+            pending = sorted(ready, key=ready.get)
+            while len(pending) >= watch_cfg["batch_files"]:
+                flush(pending[:watch_cfg["batch_files"]])
+                pending = pending[watch_cfg["batch_files"]:]
+            if pending and (stop or time.time() - ready[pending[0]] >= watch_cfg["batch_seconds"]):
+                flush(pending)
+            if stop:
+                break
+            time.sleep(watch_cfg["poll_seconds"])
+    finally:
+        engine.dispose()
+    print(f"[WATCH] Stopped after {totals['batches']} batch(es), {totals['files']} file(s), "
+          f"{totals['rows']} plays sent")
+
+# ------------------ Output ------------------
+UNKNOWN_PARTITION = "year=unknown/month=unknown"
+MANIFEST_NAME = "_manifest.json"
+
+def atomic_to_csv(df, path):
+    # Write next to the target then rename, so readers never see a half-written file
+    tmp = f"{path}.tmp"
+    df.to_csv(tmp, index=False)
+    os.replace(tmp, path)
+    return path
+
+def atomic_write_json(obj, path):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp, path)
+    return path
+
+# Submits one write job per part file; returns (futures, manifest partition entries)
+def write_partitioned(pool, df, name, out_dir, ts_col, rows_per_part):
+    table_dir = os.path.join(out_dir, name)
+    ts = to_utc(df[ts_col]) if len(df) else pd.Series([], dtype="datetime64[ns, UTC]")
+    keys = ts.dt.strftime("year=%Y/month=%m").fillna(UNKNOWN_PARTITION)
+    jobs = []
+    entries = []
+    for key, pos in sorted(df.groupby(keys.to_numpy()).indices.items()):
+        part_dir = os.path.join(table_dir, *key.split("/"))
+        os.makedirs(part_dir, exist_ok=True)
+        part_df = df.iloc[pos]
+        part_ts = ts.iloc[pos]
+        files = []
+        for n, start in enumerate(range(0, len(part_df), rows_per_part)):
+            fname = f"part-{n:05d}.csv"
+            files.append(f"{key}/{fname}")
+            chunk = part_df.iloc[start:start + rows_per_part]
+            jobs.append(pool.submit(atomic_to_csv, chunk, os.path.join(part_dir, fname)))
+        entries.append({
+            "partition": key,
+            "files": files,
+            "rows": int(len(part_df)),
+            "min_ts": part_ts.min().isoformat() if part_ts.notna().any() else None,
+            "max_ts": part_ts.max().isoformat() if part_ts.notna().any() else None,
+        })
+    return jobs, entries
+
+def remove_stale_parts(table_dir, keep):
+    # Part files left over from a previous run that the new manifest no longer references,
+    # then the year=/month= directories they leave empty (bottom-up walk)
+    keep = {os.path.normpath(os.path.join(table_dir, f)) for f in keep}
+    for root, dirs, files in os.walk(table_dir, topdown=False):
+        for f in files:
+            path = os.path.normpath(os.path.join(root, f))
+            if f.startswith("part-") and path not in keep:
+                os.remove(path)
+        if os.path.normpath(root) != os.path.normpath(table_dir) and not os.listdir(root):
+            os.rmdir(root)
+
+def read_manifest(out_dir, name):
+    path = os.path.join(out_dir, name, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+# Partitions that may hold rows in [since, until], decided from manifest min/max only (no file is opened)
+def select_partitions(manifest, since=None, until=None):
+    since = to_utc(pd.Series([since])).iloc[0] if since is not None else None
+    until = to_utc(pd.Series([until])).iloc[0] if until is not None else None
+    selected = []
+    for p in manifest["partitions"]:
+        if p["min_ts"] is None:
+            # rows without a parseable timestamp can't be pruned by time range
+            selected.append(p)
+            continue
+        if since is not None and pd.Timestamp(p["max_ts"]) < since:
+            continue
+        if until is not None and pd.Timestamp(p["min_ts"]) > until:
+            continue
+        selected.append(p)
+    return selected
+
+def write_csvs(tables, out_dir=OUT_DIR, out_cfg=None):
+    out_cfg = out_cfg or CONFIG["output"]
+    partition_by = out_cfg["partition_by"] if out_cfg["partitioned"] else {}
+    jobs = []
+    manifests = {}
+    with ThreadPoolExecutor(max_workers=out_cfg["max_workers"]) as pool:
+        for name, df in tables.items():
+            if name in partition_by:
+                part_jobs, entries = write_partitioned(pool, df, name, out_dir, partition_by[name],
+                                                       out_cfg["rows_per_part"])
+                jobs.extend(part_jobs)
+                manifests[name] = {
+                    "table": name,
+                    "partition_by": partition_by[name],
+                    "generated_at": datetime.now(timezone.utc).isoformat(),
+                    "total_rows": int(len(df)),
+                    "partitions": entries,
+                }
+            else:
+                jobs.append(pool.submit(atomic_to_csv, df, os.path.join(out_dir, f"{name}.csv")))
+        # surface the first write error, if any
+        for job in jobs:
+            job.result()
+
+    # Manifests go last: a table is only "published" once all of its parts are in place
+    for name, manifest in manifests.items():
+        table_dir = os.path.join(out_dir, name)
+        os.makedirs(table_dir, exist_ok=True)
+        atomic_write_json(manifest, os.path.join(table_dir, MANIFEST_NAME))
+        remove_stale_parts(table_dir, [f for p in manifest["partitions"] for f in p["files"]])
+        # A flat <table>.csv from before partitioning would otherwise be read as current data
+        flat = os.path.join(out_dir, f"{name}.csv")
+        if os.path.exists(flat):
+            os.remove(flat)
     print(f"[OK] CSVs written to {os.path.abspath(out_dir)}")
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python etl.py <directory|files>")
-        sys.exit(1)
-    args = sys.argv[1:]
+    ap = argparse.ArgumentParser(description="Spotify streaming logs → normalized CSV tables")
+    ap.add_argument("inputs", nargs="*", help="directories and/or JSON files (globs allowed)")
+    ap.add_argument("--resume", action="store_true", help="skip stages whose checkpoint is still valid")
+    ap.add_argument("--session-gap", type=float, metavar="MINUTES",
+                    help=f"inactivity gap that splits sessions (default {CONFIG['sessions']['gap_minutes']})")
+    ap.add_argument("--watch", metavar="DIR", help="keep running: load new files dropped in DIR into the database")
+    ap.add_argument("--batch-files", type=int, metavar="N",
+                    help=f"watch mode: max files per batch (default {CONFIG['watch']['batch_files']})")
+    ap.add_argument("--batch-seconds", type=float, metavar="S",
+                    help=f"watch mode: max wait before a partial batch runs (default {CONFIG['watch']['batch_seconds']})")
+    args = ap.parse_args()
+    if args.session_gap is not None:
+        CONFIG["sessions"]["gap_minutes"] = args.session_gap
+    if args.watch:
+        if args.batch_files is not None:
+            CONFIG["watch"]["batch_files"] = args.batch_files
+        if args.batch_seconds is not None:
+            CONFIG["watch"]["batch_seconds"] = args.batch_seconds
+        watch(args.watch, CONFIG["user"])
+        return
+    if not args.inputs:
+        ap.error("give input files/directories, or --watch DIR")
     inputs = []
-    for a in args:
+    for a in args.inputs:
         if os.path.isdir(a):
             inputs.extend(glob.glob(os.path.join(a, "*.json")))
         else:
@@ -332,13 +1151,9 @@ def main():
         print("[ERR] No JSON input files found.")
         sys.exit(1)
 
-    raw = read_json_arrays(inputs)
-    if not raw:
-        print("[ERR] No records after parsing.")
-        sys.exit(1)
-
-    tables = build_tables(raw, CONFIG["user"])
+    tables = run_pipeline(inputs, CONFIG["user"], resume=args.resume)
     write_csvs(tables)
+    graphs = write_artist_graphs(tables) if CONFIG["analytics"]["enabled"] else {}
 
     # Quick summary
     print("------ Summary ------")
@@ -348,6 +1163,9 @@ def main():
     print(f"Tracks:  {len(tables['tracks'])}")
     print(f"Feat:    {len(tables['feat'])}")
     print(f"History: {len(tables['history'])}")
+    print(f"Sessions: {len(tables['sessions'])}")
+    for name, matrix in graphs.items():
+        print(f"{name}: {len(matrix['data']) // 2} artist pairs")
 
 if __name__ == "__main__":
     main()